@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+
+# Allow direct execution
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import hashlib
+import json
+import mmap
+import multiprocessing
+import platform
+import random
+import shutil
+import statistics
+import struct
+import subprocess
+import tempfile
+import time
+import uuid
+import xml.etree.ElementTree as ET
+
+from Crypto.Cipher import AES
+from pywidevine.pssh import PSSH
+from yt_dlp import YoutubeDL
+from yt_dlp.extractor.common import InfoExtractor
+
+from yt_dlp_plugins.postprocessor.mp4decrypt import KeyStore, Mp4DecryptDecryptor, Mp4DecryptPP, _iter_boxes
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+KID = bytes.fromhex('00112233445566778899aabbccddeeff')
+KEY = bytes.fromhex('0123456789abcdef0123456789abcdef')
+KEYS = ('--key', f'{KID.hex()}:{KEY.hex()}')
+CONSTANT_IV = bytes.fromhex('f0e1d2c3b4a5968778695a4b3c2d1e0f')
+SAMPLES_PER_FRAGMENT = 48
+CLEAR_BYTES = 64
+
+
+def box(box_type, *payload):
+    data = b''.join(payload)
+    return struct.pack('>I4s', 8 + len(data), box_type) + data
+
+
+def full_box(box_type, version, flags, *payload):
+    return box(box_type, struct.pack('>I', (version << 24) | flags), *payload)
+
+
+def make_pssh(kid=KID):
+    return PSSH.new(system_id=PSSH.SystemId.Widevine, key_ids=[uuid.UUID(bytes=kid)]).dump()
+
+
+def make_init(scheme):
+    if scheme == 'cenc':
+        tenc = full_box(b'tenc', 0, 0, b'\0\0', bytes([1, 8]), KID)
+    else:
+        tenc = full_box(b'tenc', 1, 0, b'\0', bytes([0x19, 1, 0]), KID, bytes([16]), CONSTANT_IV)
+
+    sinf = box(
+        b'sinf', box(b'frma', b'avc1'), full_box(b'schm', 0, 0, scheme.encode(), struct.pack('>I', 0x10000)),
+        box(b'schi', tenc))
+    sample_entry = box(
+        b'encv', b'\0' * 6, struct.pack('>H', 1), b'\0' * 16, struct.pack('>HH', 1920, 1080), b'\0' * 50,
+        box(b'avcC', b'\x01\x64\x00\x28\xff\xe0\x00'), sinf)
+    stbl = box(
+        b'stbl', full_box(b'stsd', 0, 0, struct.pack('>I', 1), sample_entry), full_box(b'stts', 0, 0, b'\0' * 4),
+        full_box(b'stsc', 0, 0, b'\0' * 4), full_box(b'stsz', 0, 0, b'\0' * 8), full_box(b'stco', 0, 0, b'\0' * 4))
+    trak = box(
+        b'trak', full_box(b'tkhd', 0, 3, b'\0' * 8, struct.pack('>I', 1), b'\0' * 68),
+        box(b'mdia', full_box(b'mdhd', 0, 0, b'\0' * 20), box(b'minf', stbl)))
+    moov = box(
+        b'moov', full_box(b'mvhd', 0, 0, b'\0' * 96), trak,
+        box(b'mvex', full_box(b'trex', 0, 0, struct.pack('>5I', 1, 1, 0, 0, 0))), make_pssh())
+
+    return box(b'ftyp', b'isom\0\0\0\0isomdash') + moov
+
+
+def encrypt_sample(scheme, iv, sample):
+    data = bytearray(sample)
+    protected = memoryview(data)[CLEAR_BYTES:]
+
+    if scheme == 'cenc':
+        protected[:] = AES.new(KEY, AES.MODE_CTR, nonce=b'', initial_value=iv + b'\0' * 8).encrypt(protected)
+        return data
+
+    # 1:9 pattern over whole blocks, chained from the constant IV
+    offsets = range(0, len(protected) - 15, 160)
+    encrypted = AES.new(KEY, AES.MODE_CBC, CONSTANT_IV).encrypt(b''.join(protected[o:o + 16] for o in offsets))
+
+    for i, o in enumerate(offsets):
+        protected[o:o + 16] = encrypted[i * 16:i * 16 + 16]
+
+    return data
+
+
+def make_fragment(scheme, sequence, samples, rng):
+    iv_size = 8 if scheme == 'cenc' else 0
+    encrypted, aux_info = [], []
+
+    for sample in samples:
+        iv = rng.randbytes(iv_size)
+        encrypted.append(encrypt_sample(scheme, iv, sample))
+        aux_info.append(iv + struct.pack('>HHI', 1, CLEAR_BYTES, len(sample) - CLEAR_BYTES))
+
+    def make_moof(data_offset, aux_offset):
+        trun = full_box(
+            b'trun', 0, 0x201, struct.pack('>Ii', len(samples), data_offset),
+            b''.join(struct.pack('>I', len(s)) for s in samples))
+        traf = box(
+            b'traf', full_box(b'tfhd', 0, 0x20000, struct.pack('>I', 1)),
+            full_box(b'tfdt', 1, 0, struct.pack('>Q', sequence * len(samples))), trun,
+            full_box(b'saiz', 0, 0, b'\0', struct.pack('>I', len(samples)), bytes(len(a) for a in aux_info)),
+            full_box(b'saio', 0, 0, struct.pack('>II', 1, aux_offset)),
+            full_box(b'senc', 0, 2, struct.pack('>I', len(samples)), *aux_info))
+        return box(b'moof', full_box(b'mfhd', 0, 0, struct.pack('>I', sequence + 1)), traf)
+
+    moof = make_moof(0, 0)
+    # the senc box is last, so its first entry starts right after its 16-byte header
+    aux_offset = len(moof) - sum(len(a) for a in aux_info)
+    return make_moof(len(moof) + 8, aux_offset) + box(b'mdat', *encrypted)
+
+
+def make_fmp4(path, scheme, size, fragments, seed=0):
+    rng = random.Random(seed)
+    sample_size = max(CLEAR_BYTES + 16, size // (fragments * SAMPLES_PER_FRAGMENT))
+
+    with open(path, 'wb') as f:
+        f.write(make_init(scheme))
+
+        for sequence in range(fragments):
+            samples = [rng.randbytes(sample_size) for _ in range(SAMPLES_PER_FRAGMENT)]
+            f.write(make_fragment(scheme, sequence, samples, rng))
+
+
+def plaintext_digest(scheme, size, fragments, seed=0):
+    # replays the random draws of make_fmp4, including the IVs
+    rng = random.Random(seed)
+    sample_size = max(CLEAR_BYTES + 16, size // (fragments * SAMPLES_PER_FRAGMENT))
+    digest = hashlib.sha256()
+
+    for _ in range(fragments):
+        samples = [rng.randbytes(sample_size) for _ in range(SAMPLES_PER_FRAGMENT)]
+
+        for sample in samples:
+            rng.randbytes(8 if scheme == 'cenc' else 0)
+            digest.update(sample)
+
+    return digest.hexdigest()
+
+
+def mdat_digest(path):
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for box_type, _, payload, end in _iter_boxes(data):
+            if box_type == b'mdat':
+                digest.update(data[payload:end])
+
+    return digest.hexdigest()
+
+
+def make_mpd(periods, representations=3):
+    pssh = make_pssh()
+    kid = str(uuid.UUID(bytes=KID))
+    protection = (
+        f'<ContentProtection schemeIdUri="urn:mpeg:dash:mp4protection:2011" value="cenc" cenc:default_KID="{kid}"/>'
+        '<ContentProtection schemeIdUri="urn:uuid:9a04f079-9840-4286-ab92-e65be0885f95"/>'
+        '<ContentProtection schemeIdUri="urn:uuid:edef8ba9-79d6-4ace-a3c8-27dcd51d21ed">'
+        f'<cenc:pssh>{PSSH(pssh).dumps()}</cenc:pssh></ContentProtection>')
+    parts = [
+        '<?xml version="1.0" encoding="utf-8"?>'
+        '<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" xmlns:cenc="urn:mpeg:cenc:2013" type="static" '
+        f'mediaPresentationDuration="PT{periods * 10}S" minBufferTime="PT2S" '
+        'profiles="urn:mpeg:dash:profile:isoff-live:2011">']
+
+    for period in range(periods):
+        parts.append(f'<Period id="p{period}" start="PT{period * 10}S" duration="PT10S">')
+        parts.append(f'<AdaptationSet mimeType="video/mp4" segmentAlignment="true">{protection}')
+        parts.append(
+            '<SegmentTemplate timescale="1000" duration="2000" startNumber="1" '
+            'initialization="$RepresentationID$/init.mp4" media="$RepresentationID$/$Number$.m4s"/>')
+
+        for i in range(representations):
+            height = 360 * (i + 1)
+            parts.append(
+                f'<Representation id="v{height}" bandwidth="{height * 5000}" codecs="avc1.64001f" '
+                f'width="{height * 16 // 9}" height="{height}" frameRate="25"/>')
+
+        parts.append('</AdaptationSet>')
+
+        for lang, role in (('en', 'main'), ('en', 'description')):
+            parts.append(f'<AdaptationSet mimeType="audio/mp4" lang="{lang}">{protection}')
+            parts.append(f'<Role schemeIdUri="urn:mpeg:dash:role:2011" value="{role}"/>')
+            parts.append(
+                '<SegmentTemplate timescale="1000" duration="2000" startNumber="1" '
+                'initialization="$RepresentationID$/init.mp4" media="$RepresentationID$/$Number$.m4s"/>')
+            parts.append(
+                f'<Representation id="a-{role}" bandwidth="128000" codecs="mp4a.40.2" audioSamplingRate="48000"/>')
+            parts.append('</AdaptationSet>')
+
+        parts.append('</Period>')
+
+    parts.append('</MPD>')
+    return ''.join(parts)
+
+
+def _timed(func, repeat):
+    timings = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    return min(timings), statistics.median(timings)
+
+
+def bench_decrypt(path, engine, repeat, expected_digest):
+    in_place = engine == 'inplace'
+    processes = os.cpu_count() if engine == 'parallel' else 1
+    decryptor = Mp4DecryptDecryptor(
+        engine='mp4decrypt' if engine == 'mp4decrypt' else 'native', inplace=in_place, processes=processes)
+    timings = []
+
+    for _ in range(repeat):
+        filepath = path
+
+        if in_place:
+            filepath = path + '.inplace.mp4'
+            shutil.copyfile(path, filepath)
+
+        start = time.perf_counter()
+        decrypted = decryptor._decrypt_part({'format_id': 'bench', 'filepath': filepath, '_mp4decrypt': KEYS})
+        timings.append(time.perf_counter() - start)
+
+        # a broken decrypter must not post good numbers
+        if len(timings) == 1 and mdat_digest(decrypted) != expected_digest:
+            raise AssertionError(f'{engine} produced wrong plaintext')
+
+        os.remove(decrypted)
+
+    best = min(timings)
+    size = os.path.getsize(path)
+    return {
+        'seconds': best, 'median_seconds': statistics.median(timings),
+        'bytes': size, 'throughput_mbps': size / best / 1e6}
+
+
+def bench_init_probe(path, repeat):
+    with open(path, 'rb') as f:
+        init_data = f.read(Mp4DecryptPP._INIT_PROBE_SIZE)
+
+    pp = Mp4DecryptPP(YoutubeDL({'quiet': True}, auto_init=False))
+    pp._fetch_init = lambda part: init_data
+    iterations = 1000
+
+    def probe():
+        for _ in range(iterations):
+            pp._pssh_from_init({'format_id': 'bench'})
+
+    best, median = _timed(probe, repeat)
+    return {'seconds': best / iterations, 'median_seconds': median / iterations, 'ops_per_second': iterations / best}
+
+
+class _PeriodlessIE(InfoExtractor):
+    def _parse_mpd_periods(self, *args, **kwargs):
+        return iter(())
+
+
+def bench_parse_mpd(periods, mode, repeat):
+    mpd = make_mpd(periods)
+    ydl = YoutubeDL({'quiet': True}, auto_init=False)
+    # 'plugin-only' skips yt-dlp's own parsing to isolate the plugin's overhead
+    ie = _PeriodlessIE() if mode == 'plugin-only' else InfoExtractor()
+
+    if mode == 'yt-dlp':
+        ie.set_downloader(ydl)
+    else:
+        ydl.add_post_processor(Mp4DecryptPP(ydl), when='before_dl')
+        ydl.add_info_extractor(ie)
+
+    timings = []
+
+    for _ in range(repeat):
+        # the plugin modifies the document, so every run needs a fresh one
+        doc = ET.fromstring(mpd)
+        start = time.perf_counter()
+        ie._parse_mpd_formats(doc, 'dash', 'https://example.com/', 'https://example.com/manifest.mpd')
+        timings.append(time.perf_counter() - start)
+
+    best = min(timings)
+    return {
+        'seconds': best, 'median_seconds': statistics.median(timings),
+        'bytes': len(mpd), 'periods_per_second': periods / best}
+
+
+def bench_key_cache(entries, lookups, repeat):
+    rng = random.Random(0)
+    pssh_list = [f'pssh-{i}' for i in range(entries)]
+    kids = [rng.randbytes(16).hex() for _ in range(entries)]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        key_store = KeyStore(os.path.join(tmpdir, 'keys.sqlite'))
+
+        for pssh, kid in zip(pssh_list, kids):
+            key_store.store(pssh, ('--key', f'{kid}:{KEY.hex()}'))
+
+        indices = [rng.randrange(entries) for _ in range(lookups)]
+
+        pp = Mp4DecryptPP(YoutubeDL({'quiet': True}, auto_init=False))
+        pp._key_store = key_store
+
+        results = {}
+
+        for name, func in (
+            ('pssh', lambda: [key_store.get(pssh_list[i]) for i in indices]),
+            ('kid', lambda: [key_store.get_kids([kids[i]]) for i in indices]),
+            ('memory', lambda: [pp._keys_from_kids({kids[i]}) for i in indices]),
+        ):
+            best, median = _timed(func, repeat)
+            results[name] = {
+                'seconds': best / lookups, 'median_seconds': median / lookups, 'ops_per_second': lookups / best}
+
+        key_store._db.close()
+
+    return results
+
+
+def _reset_peak_rss():
+    # the peak RSS of a process otherwise includes what it inherited, so the kernel's
+    # high-water mark is reset to the current RSS where possible
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_kb():
+    try:
+        with open('/proc/self/status') as f:
+            return next(int(line.split()[1]) for line in f if line.startswith('VmHWM:'))
+    except (OSError, StopIteration):
+        pass
+
+    if not resource:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def _run_case(queue, func, args):
+    # without a reset, only the growth over the starting peak is attributable to the case
+    baseline = 0 if _reset_peak_rss() else _peak_rss_kb()
+
+    def peak_rss():
+        peak = _peak_rss_kb()
+        return peak and peak - (baseline or 0)
+
+    try:
+        queue.put((func(*args), peak_rss()))
+    except Exception as e:
+        queue.put(({'error': f'{type(e).__name__}: {e}'}, peak_rss()))
+
+
+def run_case(func, *args):
+    # every case runs in its own process so that peak RSS is attributable to it
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=_run_case, args=(queue, func, args))
+    process.start()
+    result, peak_rss = queue.get()
+    process.join()
+    return result, peak_rss
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, results):
+    previous = {r['name']: r for r in baseline['results']}
+
+    for result in results:
+        if (old := previous.get(result['name'])) and old.get('seconds') and result.get('seconds'):
+            change = (result['seconds'] / old['seconds'] - 1) * 100
+            print(f'{result["name"]:<32} {old["seconds"]:12.6f}s -> {result["seconds"]:12.6f}s {change:+7.1f}%',
+                  file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the mp4decrypt plugin using synthetic content')
+    parser.add_argument('--size', type=int, default=64, help='size in MiB of each encrypted file (default: %(default)s)')
+    parser.add_argument('--fragments', type=int, default=32, help='fragments per file (default: %(default)s)')
+    parser.add_argument('--periods', type=int, default=1000, help='periods in the MPD (default: %(default)s)')
+    parser.add_argument('--keys', type=int, default=10000, help='entries in the key cache (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each benchmark (default: %(default)s)')
+    parser.add_argument('--only', metavar='NAME', action='append', help='only run benchmarks whose name contains NAME')
+    parser.add_argument('--compare', metavar='FILE', help='compare the timings with an earlier output file')
+    parser.add_argument('-o', '--output', metavar='FILE', help='write the results to FILE instead of stdout')
+    args = parser.parse_args()
+
+    def wanted(name):
+        return not args.only or any(only in name for only in args.only)
+
+    results = []
+
+    def add(name, params, func, *func_args):
+        if not wanted(name):
+            return
+
+        print(f'Running {name}', file=sys.stderr)
+        result, peak_rss = run_case(func, *func_args)
+
+        if isinstance(result, dict) and all(isinstance(v, dict) for v in result.values()):
+            for sub_name, sub_result in result.items():
+                results.append({'name': f'{name}/{sub_name}', 'params': params, **sub_result, 'peak_rss_kb': peak_rss})
+        else:
+            results.append({'name': name, 'params': params, **result, 'peak_rss_kb': peak_rss})
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for scheme in ('cenc', 'cbcs'):
+            path = os.path.join(tmpdir, f'{scheme}.mp4')
+            file_params = {'size_mib': args.size, 'fragments': args.fragments}
+
+            if not any(wanted(f'{prefix}/{scheme}') for prefix in (
+                    'decrypt/native', 'decrypt/parallel', 'decrypt/inplace', 'decrypt/mp4decrypt', 'init-probe')):
+                continue
+
+            make_fmp4(path, scheme, args.size * 1024 * 1024, args.fragments)
+            expected_digest = plaintext_digest(scheme, args.size * 1024 * 1024, args.fragments)
+
+            for engine in ('native', 'parallel', 'inplace', 'mp4decrypt'):
+                name = f'decrypt/{engine}/{scheme}'
+
+                if engine == 'mp4decrypt' and not shutil.which('mp4decrypt'):
+                    if wanted(name):
+                        results.append({'name': name, 'params': file_params, 'skipped': 'mp4decrypt not found'})
+                    continue
+
+                add(name, file_params, bench_decrypt, path, engine, args.repeat, expected_digest)
+
+            add(f'init-probe/{scheme}', {}, bench_init_probe, path, args.repeat)
+
+    for mode in ('yt-dlp', 'plugin', 'plugin-only'):
+        add(f'parse-mpd/{mode}', {'periods': args.periods}, bench_parse_mpd, args.periods, mode, args.repeat)
+
+    add('key-cache', {'entries': args.keys, 'lookups': 1000}, bench_key_cache, args.keys, 1000, args.repeat)
+
+    output = {
+        'commit': get_commit(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(json.load(f), results)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(output, f, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
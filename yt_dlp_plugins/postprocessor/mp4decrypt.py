@@ -1,24 +1,51 @@
+import collections
+import concurrent.futures
+import contextlib
+import functools
 import hashlib
+import io
+import json
+import mmap
+import multiprocessing
 import os
 import re
+import struct
 import subprocess
 import tempfile
+import threading
+import time
+import urllib.parse
 
+from Crypto.Cipher import AES
 from pywidevine.cdm import Cdm
 from pywidevine.device import Device
 from pywidevine.pssh import PSSH
-from yt_dlp.networking.common import Request
+from yt_dlp.dependencies import sqlite3
+from yt_dlp.downloader import get_suitable_downloader
+from yt_dlp.downloader.fragment import FragmentFD
+from yt_dlp.networking.common import Request, Response
+from yt_dlp.networking.exceptions import RequestError
 from yt_dlp.postprocessor.common import PostProcessor
+from yt_dlp.postprocessor.ffmpeg import FFmpegMergerPP
 from yt_dlp.utils import (
+    DownloadError,
     Popen,
     PostProcessingError,
     UnavailableVideoError,
+    float_or_none,
+    int_or_none,
+    parse_m3u8_attributes,
     prepend_extension,
     truncate_string,
+    update_url_query,
     variadic,
 )
 
 
+def _parse_bool(value):
+    return str(value).lower() in ('1', 'true', 'yes')
+
+
 def _inject_mixin(obj, mixin, pp):
     if obj.__module__ != __name__:
         obj_type = type(obj)
@@ -29,13 +56,28 @@ def _inject_mixin(obj, mixin, pp):
 
 
 class Mp4DecryptPP(PostProcessor):
+    _INIT_PROBE_SIZE = 64 * 1024
+    _INIT_CACHE_SIZE = 8 * 1024 * 1024
+
     def __init__(self, downloader=None, **kwargs):
-        self._decryptor = Mp4DecryptDecryptor()
+        self._decryptor = Mp4DecryptDecryptor(**kwargs)
         super().__init__(downloader)
         self._kwargs = kwargs
+        self._metrics = self._decryptor._metrics
         self._pssh = {}
         self._license_urls = {}
         self._keys = {}
+        self._kids = {}
+        self._kid_keys = {}
+        self._unprotected = set()
+        self._encrypted = {}
+        self._key_store = None
+        self._init_cache = InitCache(self._INIT_CACHE_SIZE)
+        self._prefetchers = []
+        self._postprocess_queue = None
+
+        if depth := int_or_none(kwargs.get('pipeline')):
+            self._postprocess_queue = PostProcessQueue(depth)
 
     def set_downloader(self, downloader):
         _inject_mixin(downloader, Mp4DecryptDownloader, self)
@@ -48,25 +90,54 @@ class Mp4DecryptPP(PostProcessor):
 
         self._license_urls[mpd_url] = license_url
 
-    def run(self, info):
-        has_license = any(key in info for key in ('_cenc_key', '_license_url', '_license_callback'))
+    def add_m3u8(self, m3u8_url, pssh):
+        self._pssh[m3u8_url] = pssh
+
+    def add_kids(self, mpd_url, kids):
+        for format_id, format_kids in kids.items():
+            self._kids.setdefault((mpd_url, format_id), set()).update(format_kids)
 
+    def add_unprotected(self, mpd_url, format_ids):
+        self._unprotected.update((mpd_url, format_id) for format_id in format_ids)
+
+    def run(self, info):
         for part in info.get('requested_formats', (info,)):
-            if (has_license and part.get('protocol') == 'm3u8_native') or self._is_encrypted(part):
+            if self._needs_keys(info, part):
                 self._add_keys(info, part)
 
         return [], info
 
+    def _needs_keys(self, info, part):
+        has_license = any(key in info for key in ('_cenc_key', '_license_url', '_license_callback'))
+        return (has_license and part.get('protocol') == 'm3u8_native') or self._is_encrypted(part)
+
     def _is_encrypted(self, part):
         return part.get('container') in ('mp4_dash', 'm4a_dash') and \
             part.get('manifest_url') in self._license_urls
 
+    def _is_clear(self, part):
+        key = (part.get('manifest_url'), part.get('format_id'))
+
+        # formats protected in the manifest are never skipped, whatever their first init segment says
+        if key not in self._unprotected:
+            return False
+
+        if key not in self._encrypted:
+            self._probe_init(part)
+
+        return self._encrypted[key] is False
+
     def _add_keys(self, info, part):
         if '__real_download' in info:
             raise PostProcessingError(f'{self.PP_NAME} must be used with \'when=before_dl\'')
 
-        if keys := self._get_keys(info, part):
+        keys = None if self._is_clear(part) else self._get_keys(info, part)
+
+        if keys:
             part['_mp4decrypt'] = keys
+        elif self._is_clear(part):
+            self.to_screen(f'Format {part["format_id"]} is not encrypted')
+            return
         else:
             raise UnavailableVideoError('No keys found for ' + part['format_id'])
 
@@ -79,27 +150,36 @@ class Mp4DecryptPP(PostProcessor):
             return tuple([arg for key in variadic(keys, str) for arg in ('--key', key)])
 
         mpd_url = part['manifest_url']
+        kids_key = (mpd_url, part.get('format_id'))
+
+        if keys := self._keys_from_kids(self._kids.get(kids_key)):
+            self._metrics.count('key_cache', result='hit')
+            return keys
 
         if mpd_url in self._pssh:
             pssh = self._pssh[mpd_url]
+        elif pssh := self._pssh_from_init(part):
+            self._pssh[mpd_url] = pssh
         else:
-            pssh = self._pssh[mpd_url] = self._pssh_from_init(part)
-
-        if not pssh:
             return ()
 
         if keys := self._keys.get(pssh):
+            self._metrics.count('key_cache', result='hit')
             return keys
 
-        cache_args = ('mp4decrypt-pssh', hashlib.md5(pssh.encode('ascii')).hexdigest())
-
-        if (data := self._downloader.cache.load(*cache_args)) \
-                and data['pssh'] == pssh and (keys := data['keys']):
-            for i in range(1, len(keys), 2):
-                self.to_screen(f'Loaded key from cache: {keys[i]}')
+        if keys := self._load_keys(pssh):
+            self._report_cached_keys(keys)
+            self._add_kid_keys(keys)
             self._keys[pssh] = keys
+            self._metrics.count('key_cache', result='hit')
+            return keys
+
+        if keys := self._keys_from_kids(self._kids.get(kids_key) or self._pssh_kids(pssh)):
+            self._metrics.count('key_cache', result='hit')
             return keys
 
+        self._metrics.count('key_cache', result='miss')
+
         license_callback = info.get('_license_callback')
         license_urls = info.get('_license_url', self._license_urls.get(mpd_url))
         license_url = license_urls[mpd_url] if isinstance(license_urls, dict) else license_urls
@@ -113,20 +193,130 @@ class Mp4DecryptPP(PostProcessor):
                     headers={'Content-Type': 'application/octet-stream'})).read()
 
         if license_callback:
-            return self._fetch_keys(pssh, license_callback, cache_args, mpd_url, license_url)
+            return self._fetch_keys(pssh, license_callback, mpd_url, license_url)
 
         return ()
 
+    def _keys_from_kids(self, kids):
+        if not kids:
+            return None
+
+        kids = sorted(kids)
+
+        if all(kid in self._kid_keys for kid in kids):
+            return tuple(arg for kid in kids for arg in ('--key', self._kid_keys[kid]))
+
+        if keys := self._call_key_store('get_kids', kids):
+            self._report_cached_keys(keys)
+            self._add_kid_keys(keys)
+            return keys
+
+        return None
+
+    def _pssh_kids(self, pssh):
+        try:
+            return {kid.hex for kid in PSSH(pssh).key_ids}
+        except Exception as e:
+            self.write_debug(f'Unable to read KIDs from PSSH: {e}')
+            return None
+
+    def _add_kid_keys(self, keys):
+        for keyarg in keys[1::2]:
+            self._kid_keys[keyarg.partition(':')[0]] = keyarg
+
+    def _report_cached_keys(self, keys):
+        for keyarg in keys[1::2]:
+            self.to_screen(f'Loaded key from cache: {keyarg}')
+
     def _pssh_from_init(self, part):
-        def find_wv_pssh_offsets(raw):
-            offset = 0
+        init = self._probe_init(part)
+
+        if pssh := init['pssh']:
+            self.to_screen('Extracted PSSH from init segment')
+            return PSSH(bytes(pssh)).dumps()
+
+        if init['encrypted'] is not False:
+            self.report_warning('Could not find PSSH for ' + part['format_id'])
+
+        return None
+
+    def _probe_init(self, part):
+        with self._metrics.measure('init_probe') as fields:
+            try:
+                init_data = self._fetch_init(part)
+            except RequestError as e:
+                self.write_debug(f'Unable to fetch init segment: {e}')
+                init_data = None
+
+            if init_data is None:
+                init_data = self._download_init(part)
+
+            fields['size'] = len(init_data)
+
+        init = _parse_init(init_data)
+        key = (part.get('manifest_url'), part.get('format_id'))
+        self._encrypted[key] = init['encrypted']
+
+        if init['kid']:
+            self._kids.setdefault(key, set()).add(init['kid'].hex())
+
+        return init
+
+    def _fetch_init(self, part):
+        headers = part.get('http_headers') or {}
+        byte_range = (0, self._INIT_PROBE_SIZE)
+        is_init = False
+
+        if part.get('protocol') == 'http_dash_segments' and part.get('fragments'):
+            fragment = part['fragments'][0]
+            url = fragment.get('url') or urllib.parse.urljoin(part['fragment_base_url'], fragment['path'])
+            byte_range = None
+            is_init = True
+        elif part.get('protocol') == 'm3u8_native':
+            url, byte_range, is_init = self._find_hls_init(part, headers)
+        elif part.get('protocol') in ('http', 'https'):
+            url = part['url']
+        else:
+            return None
+
+        if extra_query := part.get('extra_param_to_segment_url'):
+            url = update_url_query(url, urllib.parse.parse_qs(extra_query))
+
+        if byte_range:
+            headers = {**headers, 'Range': 'bytes=%d-%d' % (byte_range[0], byte_range[0] + byte_range[1] - 1)}
+
+        request = Request(url, headers=headers)
 
-            while (offset := raw.find(b'pssh', offset)) != -1:
-                pssh_offset = offset - 4
-                size = int.from_bytes(raw[pssh_offset:offset], byteorder='big')
-                offset += size
-                yield PSSH(raw[pssh_offset:pssh_offset + size])
+        with self._downloader.urlopen(request) as response:
+            init_data = response.read(byte_range[1] if byte_range else None)
 
+        # the first fragment is requested the same way by the download, which can reuse it
+        if is_init and (not byte_range or response.status == 206):
+            self._init_cache.add(request, response, init_data)
+
+        return init_data
+
+    def _find_hls_init(self, part, headers):
+        with self._downloader.urlopen(Request(part['url'], headers=headers)) as response:
+            manifest = response.read().decode('utf-8', 'replace')
+
+        for line in manifest.splitlines():
+            if line.startswith('#EXT-X-MAP:'):
+                map_info = parse_m3u8_attributes(line[11:])
+                url = urllib.parse.urljoin(part['url'], map_info['URI'])
+
+                if byte_range := map_info.get('BYTERANGE'):
+                    size, _, offset = byte_range.partition('@')
+                    return url, (int(offset or 0), int(size)), True
+
+                return url, None, True
+
+            if line and not line.startswith('#'):
+                return urllib.parse.urljoin(part['url'], line), (0, self._INIT_PROBE_SIZE), False
+
+        return part['url'], None, False
+
+    def _download_init(self, part):
         init_data = b''
         temp_file = tempfile.NamedTemporaryFile(suffix='.tmp', delete=False)
         temp_file.close()
@@ -137,32 +327,105 @@ class Mp4DecryptPP(PostProcessor):
                 init_data = f.read()
             os.remove(temp_file.name)
 
-        for pssh in find_wv_pssh_offsets(init_data):
-            if pssh.system_id == PSSH.SystemId.Widevine:
-                self.to_screen('Extracted PSSH from init segment')
-                return pssh.dumps()
+        return init_data
+
+    def _get_key_store(self):
+        if self._key_store is None and sqlite3:
+            path = self._kwargs.get('keystore')
+
+            if not path:
+                cache = self._downloader.cache
+                path = os.path.join(cache._get_root_dir(), 'mp4decrypt-keys.sqlite') if cache.enabled else ':memory:'
+
+            try:
+                self._key_store = KeyStore(
+                    path, ttl=float_or_none(self._kwargs.get('keyttl')), limit=int_or_none(self._kwargs.get('keylimit')))
+            except (OSError, sqlite3.Error) as e:
+                self.report_warning(f'Unable to open key store {path}: {e}; using the cache directory instead')
+                self._key_store = False
+
+        return self._key_store
+
+    def _call_key_store(self, method, *args):
+        if not (key_store := self._get_key_store()):
+            return None
+
+        try:
+            return getattr(key_store, method)(*args)
+        except (OSError, sqlite3.Error) as e:
+            self.report_warning(f'Unable to access key store: {e}')
+            return None
+
+    def _load_keys(self, pssh):
+        if keys := self._call_key_store('get', pssh):
+            return keys
+
+        # keys cached by earlier versions of the plugin
+        cache_args = ('mp4decrypt-pssh', hashlib.md5(pssh.encode('ascii')).hexdigest())
+
+        if (data := self._downloader.cache.load(*cache_args)) and data['pssh'] == pssh and (keys := data['keys']):
+            self._call_key_store('store', pssh, keys)
+            return tuple(keys)
 
-        self.report_warning('Could not find PSSH for ' + part['format_id'])
         return None
 
-    def _fetch_keys(self, pssh, callback, cache_args, mpd_url, license_url=None):
+    def _store_keys(self, pssh, keys):
+        if key_store := self._get_key_store():
+            try:
+                return key_store.store(pssh, keys)
+            except (OSError, sqlite3.Error) as e:
+                self.report_warning(f'Unable to access key store: {e}')
+
+        self._downloader.cache.store(
+            'mp4decrypt-pssh', hashlib.md5(pssh.encode('ascii')).hexdigest(), {'pssh': pssh, 'keys': keys})
+
+    def _fetch_keys(self, pssh, callback, mpd_url, license_url=None):
+        kids = self._pssh_kids(pssh)
+
+        try:
+            keys = _license_requests.do(
+                frozenset(kids or ()) or pssh,
+                lambda: self._request_uncached_keys(pssh, kids, callback, license_url),
+                float_or_none(self._kwargs.get('licensetimeout'), default=120))
+        except concurrent.futures.TimeoutError:
+            raise PostProcessingError('Timed out waiting for another license request for the same keys')
+
+        self._keys[pssh] = keys
+
+        if keys:
+            self._add_kid_keys(keys)
+
+        return keys
+
+    def _request_uncached_keys(self, pssh, kids, callback, license_url):
+        # a request for the same keys may have finished after the caller missed the cache
+        if keys := self._keys.get(pssh) or self._load_keys(pssh) or self._keys_from_kids(kids):
+            return keys
+
+        return self._request_keys(pssh, callback, license_url)
+
+    def _request_keys(self, pssh, callback, license_url):
         keys = ()
 
         if devicepath := self._kwargs.get('devicepath'):
-            cdm = Cdm.from_device(Device.load(devicepath))
-            session_id = cdm.open()
-            challenge = cdm.get_license_challenge(session_id, PSSH(pssh), 'STREAMING', privacy_mode=True)
-            license_msg = callback(challenge, license_url) if license_url else callback(challenge)
-            cdm.parse_license(session_id, license_msg)
+            with _cdm_pool.session(devicepath) as (cdm, session_id):
+                with self._metrics.measure('challenge'):
+                    challenge = cdm.get_license_challenge(session_id, PSSH(pssh), 'STREAMING', privacy_mode=True)
 
-            for key in cdm.get_keys(session_id):
-                if key.type == 'CONTENT':
-                    keyarg = f'{key.kid.hex}:{key.key.hex()}'
-                    self.to_screen(f'Fetched key: {keyarg}')
-                    keys += ('--key', keyarg)
+                with self._metrics.measure('license', host=urllib.parse.urlparse(license_url or '').hostname or 'unknown'):
+                    license_msg = callback(challenge, license_url) if license_url else callback(challenge)
+
+                cdm.parse_license(session_id, license_msg)
+
+                for key in cdm.get_keys(session_id):
+                    if key.type == 'CONTENT':
+                        keyarg = f'{key.kid.hex}:{key.key.hex()}'
+                        self.to_screen(f'Fetched key: {keyarg}')
+                        keys += ('--key', keyarg)
+
+        if keys:
+            self._store_keys(pssh, keys)
 
-        self._keys[pssh] = keys
-        self._downloader.cache.store(*cache_args, {'pssh': pssh, 'keys': keys})
         return keys
 
 
@@ -171,41 +434,410 @@ class Mp4DecryptDownloader:
         _inject_mixin(ie, Mp4DecryptExtractor, self._mixin_pp)
         return self._mixin_class.add_info_extractor(self, ie)
 
+    def urlopen(self, req):
+        if isinstance(req, Request) and (response := self._mixin_pp._init_cache.pop(req)):
+            self.write_debug('Reusing probed init segment ' + req.url)
+            return response
+
+        return self._mixin_class.urlopen(self, req)
+
+    def process_ie_result(self, ie_result, download=True, extra_info=None):
+        pp = self._mixin_pp
+
+        with pp._postprocess_queue or contextlib.nullcontext():
+            if pp._prefetchers and extra_info and 'playlist_index' in extra_info:
+                pp._prefetchers[-1].advance(extra_info['playlist_index'])
+
+            if not download or ie_result.get('_type') not in ('playlist', 'multi_video') \
+                    or not (lookahead := int_or_none(pp._kwargs.get('prefetch'))):
+                return self._mixin_class.process_ie_result(self, ie_result, download, extra_info)
+
+            prefetcher = KeyPrefetcher(pp, ie_result, lookahead, int_or_none(pp._kwargs.get('prefetchworkers')) or 2)
+            pp._prefetchers.append(prefetcher)
+
+            try:
+                return self._mixin_class.process_ie_result(self, ie_result, download, extra_info)
+            finally:
+                pp._prefetchers.pop()
+                prefetcher.close()
+
+    def post_process(self, filename, info, files_to_move=None):
+        pp = self._mixin_pp
+
+        # post hooks expect the final file, so they rule out finishing in the background
+        if not pp._postprocess_queue or self._post_hooks or pp._decryptor not in info.get('__postprocessors', []):
+            return self._mixin_class.post_process(self, filename, info, files_to_move)
+
+        info['filepath'] = filename
+        # the caller strips fields it shares with the parent info once post_process returns
+        pp._postprocess_queue.submit(
+            self._make_archive_id(info), self._post_process_in_background, filename, info, dict(info), files_to_move)
+        return info
+
+    def _post_process_in_background(self, filename, info, original, files_to_move):
+        try:
+            result = self._mixin_class.post_process(self, filename, dict(original), files_to_move)
+        except PostProcessingError as err:
+            # report_error raises unless ignoreerrors is set, which would fail whichever video is downloading next
+            with contextlib.suppress(DownloadError):
+                self.report_error(f'Postprocessing: {err}')
+            return False
+
+        info.update({key: value for key, value in result.items() if original.get(key) is not value})
+        return True
+
+    def run_all_pps(self, key, info, *, additional_pps=None):
+        if key in ('after_video', 'playlist') and (queue := self._mixin_pp._postprocess_queue) and (
+                self._pps[key] or key in self.params.get('forceprint', {})
+                or key in self.params.get('print_to_file', {})):
+            queue.join()
+
+        return self._mixin_class.run_all_pps(self, key, info, additional_pps=additional_pps)
+
+    def record_download_archive(self, info_dict):
+        if queue := self._mixin_pp._postprocess_queue:
+            queue.after(self._make_archive_id(info_dict), self._mixin_class.record_download_archive, self, info_dict)
+        else:
+            self._mixin_class.record_download_archive(self, info_dict)
+
+    def dl(self, name, info, subtitle=False, test=False):
+        if test or not info.get('url') or not _parse_bool(self._mixin_pp._kwargs.get('stream')) \
+                or not any('_mp4decrypt' in f for f in info.get('requested_formats') or (info,)):
+            return self._mixin_class.dl(self, name, info, subtitle, test)
+
+        # a resumed download would mix decrypted and encrypted fragments
+        params = {**self.params, 'continuedl': False}
+        fd_class = get_suitable_downloader(info, params, to_stdout=(name == '-'))
+
+        if not issubclass(fd_class, FragmentFD):
+            return self._mixin_class.dl(self, name, info, subtitle, test)
+
+        fd = fd_class(self, params)
+        _inject_mixin(fd, Mp4DecryptFragmentDownloader, self._mixin_pp)
+
+        for ph in self._progress_hooks:
+            fd.add_progress_hook(ph)
+
+        self.write_debug(f'Invoking {fd.FD_NAME} downloader with on-the-fly decryption')
+        new_info = self._copy_infodict(info)
+
+        if new_info.get('http_headers') is None:
+            new_info['http_headers'] = self._calc_headers(new_info)
+
+        return fd.download(name, new_info, subtitle)
+
+
+class Mp4DecryptFragmentDownloader:
+    def download_and_append_fragments(self, ctx, fragments, info_dict, **kwargs):
+        if not (keys := info_dict.get('_mp4decrypt')):
+            return self._mixin_class.download_and_append_fragments(self, ctx, fragments, info_dict, **kwargs)
+
+        pack_func = kwargs.pop('pack_func', None) or (lambda content, _: content)
+        decrypter = CencDecrypter(keys)
+        state = {'streaming': None}
+
+        def decrypt_fragment(frag_content, frag_index):
+            frag_content = pack_func(frag_content, frag_index)
+
+            if state['streaming'] is False:
+                return frag_content
+
+            try:
+                if state['streaming'] is None and not _find_box(frag_content, 0, len(frag_content), b'moov'):
+                    raise CencUnsupportedError('first fragment has no initialization data')
+
+                frag_content = decrypter.decrypt_fragment(frag_content)
+            except (CencUnsupportedError, PostProcessingError) as e:
+                if state['streaming']:
+                    raise DownloadError(f'Unable to decrypt fragment {frag_index}: {e}')
+
+                self.report_warning(f'Unable to decrypt while downloading ({e}); decrypting after download instead')
+                state['streaming'] = False
+                return frag_content
+
+            state['streaming'] = True
+            return frag_content
+
+        result = self._mixin_class.download_and_append_fragments(
+            self, ctx, fragments, info_dict, **kwargs, pack_func=decrypt_fragment)
+
+        if result and state['streaming']:
+            self._mixin_pp._decryptor._streamed_files.add(ctx['filename'])
+
+        return result
+
+
+class Mp4DecryptMerger:
+    _decryption_keys = None
+
+    def run(self, info):
+        if not (merge_keys := info.pop('__mp4decrypt_merge_keys', None)):
+            return self._mixin_class.run(self, info)
+
+        parts = [part for part in info['requested_formats'] if part.get('filepath') in merge_keys]
+        self._decryption_keys = merge_keys
+
+        try:
+            result = self._mixin_class.run(self, info)
+        except PostProcessingError as e:
+            self.report_warning(f'Unable to decrypt while merging ({e}); decrypting before merging instead')
+        else:
+            for part in parts:
+                del part['_mp4decrypt']
+            return result
+        finally:
+            self._decryption_keys = None
+
+        to_delete = []
+        self._mixin_pp.to_screen(
+            '[Mp4Decrypt] Decrypting format(s) ' + ', '.join(p['format_id'] for p in parts), prefix=False)
+        self._mixin_pp._decrypt_parts(info, parts, to_delete)
+
+        for part in parts:
+            del part['_mp4decrypt']
+
+        files_to_delete, info = self._mixin_class.run(self, info)
+        return files_to_delete + to_delete, info
+
+    def real_run_ffmpeg(self, input_path_opts, output_path_opts, **kwargs):
+        if merge_keys := self._decryption_keys:
+            input_path_opts = [
+                (path, ['-decryption_key', merge_keys[path], *opts] if path in merge_keys else opts)
+                for path, opts in input_path_opts]
+
+        return self._mixin_class.real_run_ffmpeg(self, input_path_opts, output_path_opts, **kwargs)
+
+
+class KeyPrefetcher:
+    def __init__(self, pp, playlist, lookahead, workers):
+        self._pp = pp
+        self._playlist = playlist
+        self._lookahead = lookahead
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='mp4decrypt-prefetch')
+        self._order = None
+        self._submitted = set()
+
+    def advance(self, playlist_index):
+        if self._order is None:
+            self._order = self._get_order()
+
+        position = next((i for i, (index, _) in enumerate(self._order) if index == playlist_index), None)
+
+        if position is None:
+            return
+
+        for index, entry in self._order[position + 1:position + 1 + self._lookahead]:
+            if index not in self._submitted and entry:
+                self._submitted.add(index)
+                self._executor.submit(self._prefetch, index, entry)
+
+    def _get_order(self):
+        params = self._pp._downloader.params
+
+        # entries are only known in advance if the playlist has been fully resolved
+        if params.get('lazy_playlist') or params.get('playlistrandom') \
+                or not self._playlist.get('requested_entries'):
+            return []
+
+        order = list(zip(self._playlist['requested_entries'], self._playlist['entries']))
+        return order[::-1] if params.get('playlistreverse') else order
+
+    def _prefetch(self, index, entry):
+        try:
+            info = self._extract(entry)
+
+            if not info or info.get('_type', 'video') != 'video':
+                return
+
+            manifest_urls = set()
+
+            for fmt in info.get('formats') or (info,):
+                if self._pp._needs_keys(info, fmt) and fmt.get('manifest_url') not in manifest_urls:
+                    manifest_urls.add(fmt.get('manifest_url'))
+                    self._pp._get_keys(info, fmt)
+        except Exception as e:
+            self._pp.write_debug(f'Unable to prefetch keys for playlist item {index}: {e}')
+
+    def _extract(self, entry):
+        if entry.get('_type', 'video') == 'video':
+            return entry
+
+        if entry.get('_type') not in ('url', 'url_transparent'):
+            return None
+
+        ydl = self._pp._downloader
+        ie_key = entry.get('ie_key') or next((key for key, ie in ydl._ies.items() if ie.suitable(entry['url'])), None)
+
+        if not ie_key:
+            return None
+
+        # extractors may keep per-call state on the instance (e.g. swapped methods),
+        # so the foreground instance is never shared with a prefetch thread
+        return type(ydl.get_info_extractor(ie_key))(ydl).extract(entry['url'])
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class PostProcessQueue:
+    def __init__(self, depth):
+        self._depth = depth
+        self._executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='mp4decrypt-postprocess')
+        self._futures = collections.deque()
+        self._nesting = 0
+        self._lock = threading.Lock()
+        self._pending = collections.Counter()
+        self._failed = set()
+        self._callbacks = {}
+
+    def __enter__(self):
+        self._nesting += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self._nesting -= 1
+
+        if not self._nesting:
+            self.join()
+
+    def submit(self, key, func, *args):
+        self._wait(self._depth - 1)
+
+        with self._lock:
+            self._pending[key] += 1
+
+        self._futures.append(self._executor.submit(self._run, key, func, *args))
+
+    def after(self, key, func, *args):
+        with self._lock:
+            if key in self._failed:
+                self._failed.remove(key)
+            elif self._pending[key]:
+                self._callbacks[key] = (func, args)
+            else:
+                func(*args)
+
+    def join(self):
+        self._wait(0)
+
+    def _wait(self, limit):
+        while self._futures and (len(self._futures) > limit or self._futures[0].done()):
+            self._futures.popleft().result()
+
+    def _run(self, key, func, *args):
+        success = False
+
+        try:
+            success = func(*args)
+        finally:
+            with self._lock:
+                self._pending[key] -= 1
+
+                if not success:
+                    self._failed.add(key)
+
+                if not self._pending[key]:
+                    del self._pending[key]
+                    callback = self._callbacks.pop(key, None)
+
+                    if callback and key not in self._failed:
+                        callback[0](*callback[1])
+
+        return success
+
 
 class Mp4DecryptExtractor:
     def _parse_mpd_periods(self, mpd_doc, mpd_id=None, *args, **kwargs):
-        elements = mpd_doc.findall('.//{*}ContentProtection')
-        found = False
-
-        for element in elements:
-            if element.get('schemeIdUri').lower() == PSSH.SystemId.Widevine.urn:
-                self._mixin_pp.add_mpd(
-                    kwargs.get('mpd_url') or args[1],
-                    element.findtext('./{*}pssh'),
-                    element.get('{urn:brightcove:2015}licenseAcquisitionUrl'),
-                )
-                found = True
-
-        if elements and found:
-            # treat formats as unprotected
-            for parent in mpd_doc.findall('.//*/..[{*}ContentProtection]'):
-                for child in parent.findall('{*}ContentProtection'):
-                    parent.remove(child)
+        start = time.perf_counter()
+        widevine_urn = PSSH.SystemId.Widevine.urn
+        protections, kids, roles, format_ids, protected_ids = [], {}, {}, set(), set()
+        found = None
+
+        def add_protection(parent, element):
+            nonlocal found
+            protections.append((parent, element))
+
+            if (element.get('schemeIdUri') or '').lower() == widevine_urn:
+                pssh = next((e.text for e in element if e.tag.rpartition('}')[2] == 'pssh'), None)
+                license_url = element.get('{urn:brightcove:2015}licenseAcquisitionUrl')
+
+                # multi-period manifests repeat the same protection in every period
+                if found != (pssh, license_url):
+                    self._mixin_pp.add_mpd(kwargs.get('mpd_url') or args[1], pssh, license_url)
+                    found = (pssh, license_url)
 
-        roles = {}
+            if kid := element.get('{urn:mpeg:cenc:2013}default_KID'):
+                return kid.replace('-', '').lower()
 
-        for adaptation_set in mpd_doc.findall('.//{*}AdaptationSet'):
-            if adaptation_set.get('mimeType') != 'audio/mp4' and \
-                    adaptation_set.get('contentType') != 'audio':
+            return None
+
+        # ContentProtection may only appear in MPD, AdaptationSet and Representation elements,
+        # so segment lists and timelines never need to be visited
+        protected, mpd_kid = False, None
+
+        for child in mpd_doc:
+            tag = child.tag.rpartition('}')[2]
+
+            if tag == 'ContentProtection':
+                mpd_kid = mpd_kid or add_protection(mpd_doc, child)
+                protected = True
+            elif tag != 'Period':
                 continue
-            if (role := adaptation_set.find('{*}Role')) is not None:
-                for representation in adaptation_set.findall('{*}Representation[@id]'):
-                    format_id = representation.get('id')
+
+            for adaptation_set in child.iterfind('{*}AdaptationSet'):
+                set_kid, role, representations = None, None, []
+                set_protected = protected
+
+                for element in adaptation_set:
+                    tag = element.tag.rpartition('}')[2]
+
+                    if tag == 'ContentProtection':
+                        kid = add_protection(adaptation_set, element)
+                        set_kid = set_kid or kid
+                        set_protected = True
+                    elif tag == 'Role' and role is None:
+                        role = element
+                    elif tag == 'Representation':
+                        representations.append(element)
+
+                is_audio = adaptation_set.get('mimeType') == 'audio/mp4' or adaptation_set.get('contentType') == 'audio'
+
+                for representation in representations:
+                    representation_kid = None
+                    representation_protected = set_protected
+
+                    for element in representation:
+                        if element.tag.rpartition('}')[2] == 'ContentProtection':
+                            kid = add_protection(representation, element)
+                            representation_kid = representation_kid or kid
+                            representation_protected = True
+
+                    if (format_id := representation.get('id')) is None:
+                        continue
 
                     if mpd_id:
                         format_id = mpd_id + '-' + format_id
 
-                    roles[format_id] = role.get('value')
+                    # keys may rotate between periods, so every period's KID is needed
+                    if kid := representation_kid or set_kid or mpd_kid:
+                        kids.setdefault(format_id, set()).add(kid)
+
+                    format_ids.add(format_id)
+
+                    # a format is only clear if it is unprotected in every period
+                    if representation_protected:
+                        protected_ids.add(format_id)
+
+                    if is_audio and role is not None:
+                        roles[format_id] = role.get('value')
+
+        if found is not None:
+            self._mixin_pp.add_kids(kwargs.get('mpd_url') or args[1], kids)
+            self._mixin_pp.add_unprotected(kwargs.get('mpd_url') or args[1], format_ids - protected_ids)
+
+            # treat formats as unprotected
+            for parent, element in protections:
+                parent.remove(element)
 
         for period_entry in self._mixin_class._parse_mpd_periods(self, mpd_doc, mpd_id, *args, **kwargs):
             for fmt in period_entry['formats']:
@@ -216,6 +848,27 @@ class Mp4DecryptExtractor:
 
             yield period_entry
 
+        self._mixin_pp._metrics.record('mpd_parse', time.perf_counter() - start)
+
+    def _parse_m3u8_formats_and_subtitles(self, m3u8_doc, m3u8_url=None, *args, **kwargs):
+        widevine_urn = PSSH.SystemId.Widevine.urn
+
+        for line in (m3u8_doc or '').splitlines() if m3u8_url else ():
+            if not line.startswith(('#EXT-X-KEY:', '#EXT-X-SESSION-KEY:')):
+                continue
+
+            key_info = parse_m3u8_attributes(line.partition(':')[2])
+            uri = key_info.get('URI') or ''
+
+            if (key_info.get('KEYFORMAT') or '').lower() == widevine_urn and uri.startswith('data:'):
+                try:
+                    self._mixin_pp.add_m3u8(m3u8_url, PSSH(uri.partition(',')[2]).dumps())
+                    break
+                except Exception as e:
+                    self.write_debug(f'Unable to read PSSH from playlist: {e}')
+
+        return self._mixin_class._parse_m3u8_formats_and_subtitles(self, m3u8_doc, m3u8_url, *args, **kwargs)
+
     def _parse_brightcove_metadata(self, json_data, *args, **kwargs):
         for source in json_data.get('sources') or []:
             if 'com.widevine.alpha' in source.get('key_systems', {}):
@@ -269,6 +922,12 @@ class Mp4DecryptExtractor:
 
 
 class Mp4DecryptDecryptor(PostProcessor):
+    def __init__(self, downloader=None, **kwargs):
+        super().__init__(downloader)
+        self._kwargs = kwargs
+        self._streamed_files = set()
+        self._metrics = Metrics(kwargs.get('metrics'), kwargs.get('prometheus'))
+
     def run(self, info):
         to_delete, encrypted = [], []
 
@@ -277,23 +936,140 @@ class Mp4DecryptDecryptor(PostProcessor):
         elif info.get('__real_download') and self._is_encrypted(info):
             encrypted.append(info)
 
-        if encrypted:
-            self.to_screen('[Mp4Decrypt] Decrypting format(s)', prefix=False)
-            for part in encrypted:
-                self._decrypt_part(info, part, to_delete)
+        pending = []
+
+        for part in encrypted:
+            if part['filepath'] in self._streamed_files:
+                self._streamed_files.remove(part['filepath'])
+                self.write_debug('Format ' + part['format_id'] + ' was decrypted while downloading')
+            elif self._is_clear(part['filepath']):
+                self.to_screen(f'[Mp4Decrypt] Format {part["format_id"]} is not encrypted', prefix=False)
+            else:
+                pending.append(part)
+
+        if pending and _parse_bool(self._kwargs.get('mergedecrypt')):
+            pending = self._defer_to_merger(info, pending)
+
+        if pending:
+            self.to_screen('[Mp4Decrypt] Decrypting format(s) ' + ', '.join(p['format_id'] for p in pending), prefix=False)
+            self._decrypt_parts(info, pending, to_delete)
+
+        merge_keys = info.get('__mp4decrypt_merge_keys') or {}
+
+        for part in encrypted:
+            if part['filepath'] not in merge_keys:
                 del part['_mp4decrypt']
 
         return to_delete, info
 
+    def _defer_to_merger(self, info, parts):
+        postprocessors = info.get('__postprocessors') or []
+        merger = next((
+            pp for pp in postprocessors[postprocessors.index(self) + 1:]
+            if isinstance(pp, FFmpegMergerPP)), None) if self in postprocessors else None
+
+        if not merger or not merger.available:
+            return parts
+
+        merge_keys, remaining = {}, []
+
+        for part in parts:
+            if key := self._get_merge_key(info, part):
+                merge_keys[part['filepath']] = key
+            else:
+                remaining.append(part)
+
+        if merge_keys:
+            self.to_screen('[Mp4Decrypt] Decrypting format(s) {} while merging'.format(', '.join(
+                p['format_id'] for p in parts if p['filepath'] in merge_keys)), prefix=False)
+            info['__mp4decrypt_merge_keys'] = merge_keys
+            _inject_mixin(merger, Mp4DecryptMerger, self)
+
+        return remaining
+
+    def _get_merge_key(self, info, part):
+        keys = part['_mp4decrypt']
+
+        # ffmpeg takes a single key per input
+        if part['filepath'] not in info.get('__files_to_merge', []) or len(keys) != 2:
+            return None
+
+        kid, _, key = keys[1].partition(':')
+
+        with open(part['filepath'], 'rb') as f:
+            init = _parse_init(f.read(Mp4DecryptPP._INIT_PROBE_SIZE))
+
+        if init['scheme'] != 'cenc' or not init['kid'] or init['kid'].hex() != kid.lower():
+            return None
+
+        return key
+
     def _is_encrypted(self, info):
         return 'filepath' in info and '_mp4decrypt' in info
 
-    def _decrypt_part(self, info, part, to_delete):
+    def _is_clear(self, filepath):
+        if not os.path.getsize(filepath):
+            return False
+
+        clear = False
+
+        # every init segment and fragment is checked, as a clear lead may be followed by encrypted periods
+        with open(filepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for box_type, box_start, _, box_end in _iter_boxes(data):
+                if box_type not in (b'moov', b'moof'):
+                    continue
+
+                encrypted = _parse_init(data[box_start:box_end])['encrypted']
+
+                if encrypted or (box_type == b'moov' and encrypted is None):
+                    return False
+
+                clear = clear or box_type == b'moov'
+
+        return clear
+
+    def _decrypt_parts(self, info, parts, to_delete):
+        workers = int_or_none(self._kwargs.get('workers')) or os.cpu_count() or 1
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(workers, len(parts)))) as pool:
+            futures = [pool.submit(self._decrypt_part, part) for part in parts]
+
+        errors = []
+
+        for part, future in zip(parts, futures):
+            if error := future.exception():
+                errors.append((part, error))
+            else:
+                self._replace_part(info, part, future.result(), to_delete)
+
+        if errors:
+            raise PostProcessingError('Unable to decrypt format(s):\n' + '\n'.join(
+                f'{part["format_id"]}: {error}' for part, error in errors)) from errors[0][1]
+
+    def _decrypt_part(self, part):
         filepath = part['filepath']
+
+        if _parse_bool(self._kwargs.get('inplace')):
+            try:
+                with self._metrics.measure('decrypt', engine='inplace', size=os.path.getsize(filepath)):
+                    CencDecrypter(part['_mp4decrypt']).decrypt_in_place(
+                        filepath, CencJournal(filepath + '.mp4decrypt-journal'))
+                return filepath
+            except CencUnsupportedError as e:
+                self.report_warning(f'Unable to decrypt {part["format_id"]} in place ({e}); decrypting to a copy')
+
         tmppath = prepend_extension(filepath, 'decrypted')
 
         if not os.path.exists(tmppath):
-            self._run_mp4decrypt(filepath, tmppath, part['_mp4decrypt'])
+            self._decrypt_file(filepath, tmppath, part['_mp4decrypt'])
+
+        return tmppath
+
+    def _replace_part(self, info, part, tmppath, to_delete):
+        filepath = part['filepath']
+
+        if tmppath == filepath:
+            return
 
         if filepath in info.get('__files_to_merge', []):
             idx = info['__files_to_merge'].index(filepath)
@@ -302,6 +1078,40 @@ class Mp4DecryptDecryptor(PostProcessor):
         else:
             os.replace(tmppath, filepath)
 
+    def _decrypt_file(self, filepath, tmppath, keys):
+        engine = self._kwargs.get('engine', 'mp4decrypt')
+
+        size = os.path.getsize(filepath)
+
+        if engine == 'native':
+            try:
+                with self._metrics.measure('decrypt', engine='native', size=size):
+                    return self._run_native(filepath, tmppath, keys)
+            except CencUnsupportedError as e:
+                self.report_warning(f'Unable to decrypt natively ({e}); falling back to mp4decrypt')
+        elif engine != 'mp4decrypt':
+            raise PostProcessingError(f'Unknown decryption engine: {engine}')
+
+        with self._metrics.measure('decrypt', engine='mp4decrypt', size=size):
+            self._run_mp4decrypt(filepath, tmppath, keys)
+
+    def _run_native(self, filepath, tmppath, keys):
+        processes = int_or_none(self._kwargs.get('processes')) or 1
+
+        try:
+            try:
+                if processes > 1 and CencDecrypter(keys).decrypt_parallel(filepath, tmppath, processes):
+                    return
+            except concurrent.futures.BrokenExecutor as e:
+                self.report_warning(f'Unable to decrypt in {processes} processes ({e}); decrypting in one process instead')
+
+            with open(filepath, 'rb') as infile, open(tmppath, 'wb') as outfile:
+                CencDecrypter(keys).decrypt(infile, outfile)
+        except BaseException:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            raise
+
     def _run_mp4decrypt(self, filepath, tmppath, keys):
         cwd = os.path.dirname(filepath)
         filename = os.path.basename(filepath)
@@ -330,3 +1140,1064 @@ class Mp4DecryptDecryptor(PostProcessor):
 
         for from_name, to_name in renames.items():
             os.replace(os.path.join(cwd, from_name), os.path.join(cwd, to_name))
+
+
+class CencUnsupportedError(Exception):
+    pass
+
+
+def _reject_malformed(func):
+    # offsets and sizes come straight from the file, so bad ones surface as lookup or unpacking errors
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except (struct.error, IndexError, ValueError) as e:
+            raise CencUnsupportedError(f'malformed or truncated box ({e})') from e
+
+    return wrapper
+
+
+def _iter_boxes(data, start=0, end=None, truncated=False):
+    end = len(data) if end is None else end
+
+    while start + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, start)
+        header_size = 8
+
+        if size == 1:
+            if start + 16 > end:
+                return
+            size = struct.unpack_from('>Q', data, start + 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = end - start
+
+        if size < header_size or (start + size > end and not truncated):
+            return
+
+        yield box_type, start, start + header_size, start + size
+        start += size
+
+
+def _find_box(data, start, end, *path):
+    for box_type, _, payload, box_end in _iter_boxes(data, start, end):
+        if box_type == path[0]:
+            return (payload, box_end) if len(path) == 1 else _find_box(data, payload, box_end, *path[1:])
+
+    return None
+
+
+def _sample_entry_children(data, entry_type, payload):
+    if entry_type == b'encv':
+        return payload + 78
+
+    if entry_type == b'enca':
+        return payload + 28 + {1: 16, 2: 36}.get(struct.unpack_from('>H', data, payload + 8)[0], 0)
+
+    return None
+
+
+def _parse_tenc(data, offset, version):
+    pattern, protected, iv_size = struct.unpack_from('>xBBB', data, offset)
+    info = {
+        'protected': protected,
+        'iv_size': iv_size,
+        'kid': bytes(data[offset + 4:offset + 20]),
+        'crypt': pattern >> 4 if version else 0,
+        'skip': pattern & 0xf if version else 0,
+        'constant_iv': None,
+    }
+
+    if protected and not iv_size:
+        info['constant_iv'] = bytes(data[offset + 21:offset + 21 + data[offset + 20]])
+
+    return info
+
+
+def _parse_init(data):
+    data = memoryview(data)
+    info = {'pssh': None, 'kid': None, 'scheme': None, 'iv_size': None, 'encrypted': None}
+    containers = (b'moov', b'trak', b'mdia', b'minf', b'stbl', b'sinf', b'schi', b'moof', b'traf')
+
+    def walk(start, end):
+        for box_type, box_start, payload, box_end in _iter_boxes(data, start, end, truncated=True):
+            if box_type in (b'encv', b'enca', b'senc') or (
+                    box_type == b'uuid' and data[payload:payload + 16] == CencDecrypter._PIFF_SENC_UUID):
+                info['encrypted'] = True
+
+            if box_type in containers:
+                walk(payload, min(box_end, end))
+            elif box_type == b'stsd':
+                # the sample entries are only conclusive if none of them is cut off
+                if box_end <= end and not info['encrypted']:
+                    info['encrypted'] = False
+                walk(payload + 8, min(box_end, end))
+            elif box_end > end:
+                break
+            elif (children := _sample_entry_children(data, box_type, payload)) is not None:
+                walk(children, box_end)
+            elif box_type == b'pssh':
+                if not info['pssh'] and data[payload + 4:payload + 20] == PSSH.SystemId.Widevine.bytes:
+                    info['pssh'] = data[box_start:box_end]
+            elif box_type == b'schm':
+                info['scheme'] = bytes(data[payload + 4:payload + 8]).decode('latin-1')
+            elif box_type == b'tenc' and not info['kid']:
+                tenc = _parse_tenc(data, payload + 4, data[payload])
+                info.update(kid=tenc['kid'], iv_size=tenc['iv_size'])
+
+            # only the first fragment is checked for sample encryption
+            if box_type == b'moof':
+                break
+
+    walk(0, len(data))
+    return info
+
+
+class CencDecrypter:
+    _BUFFER_SIZE = 1 << 20
+    _PARALLEL_CHUNK_SIZE = 16 << 20
+    _PIFF_SENC_UUID = bytes.fromhex('a2394f525a9b4f14a2446c427c648df4')
+
+    def __init__(self, keys):
+        self._keyargs = keys
+        self._keys = {}
+        self._tracks = {}
+        self._samples = []
+        self._position = 0
+
+        for keyarg in keys[1::2]:
+            kid, key = keyarg.split(':')
+            self._keys[bytes.fromhex(kid) if len(kid) == 32 else int(kid)] = bytes.fromhex(key)
+
+    def decrypt(self, infile, outfile):
+        infile.seek(0, os.SEEK_END)
+        file_size = infile.tell()
+        infile.seek(0)
+        self._process(infile, outfile, file_size)
+
+        if self._samples:
+            raise CencUnsupportedError('sample data lies outside of the file')
+
+    def decrypt_in_place(self, path, journal):
+        with open(path, 'r+b') as f:
+            if not (file_size := os.fstat(f.fileno()).st_size):
+                raise CencUnsupportedError('file is empty')
+
+            with mmap.mmap(f.fileno(), 0) as data:
+                resume_offset = journal.recover(data)
+                moov, fragments = self._scan_fragments(data, resume_offset)
+                check = (0, b'')
+
+                for start, payload, end, fragment_end in fragments:
+                    # the original bytes of the fragment allow an interrupted run to start it over
+                    journal.write(file_size, start, (start, data[start:fragment_end]), check)
+                    moof, samples = self._decrypt_fragment_at(data, start, payload, end)
+
+                    for offset, sample_data in samples:
+                        data[offset:offset + len(sample_data)] = sample_data
+
+                    data[start:end] = moof
+                    page = start - start % mmap.ALLOCATIONGRANULARITY
+                    data.flush(page, fragment_end - page)
+                    check = (start, bytes(moof))
+
+                if moov:
+                    start, box, _ = moov
+                    journal.write(file_size, file_size, (start, data[start:start + len(box)]), check)
+                    data[start:start + len(box)] = box
+                    data.flush()
+
+        journal.remove()
+
+    def decrypt_parallel(self, inpath, outpath, processes):
+        file_size = os.path.getsize(inpath)
+        chunk_size = max(self._PARALLEL_CHUNK_SIZE, file_size // (processes * 4))
+
+        if file_size < 2 * chunk_size:
+            return False
+
+        with open(inpath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            try:
+                moov, fragments = self._scan_fragments(data, 0)
+            except CencUnsupportedError:
+                return False
+
+            chunks = []
+
+            for fragment in fragments:
+                if not chunks or fragment[3] - chunks[-1][0][0] > chunk_size:
+                    chunks.append([])
+                chunks[-1].append(fragment)
+
+            if not moov or len(chunks) < 2:
+                return False
+
+            with open(outpath, 'wb') as outfile:
+                outfile.truncate(file_size)
+
+            # forking would copy the locks of the download, pipeline and token threads mid-use,
+            # so workers start afresh and only import the module-level _decrypt_fragments
+            with concurrent.futures.ProcessPoolExecutor(
+                    min(processes, len(chunks)), mp_context=multiprocessing.get_context('spawn')) as pool:
+                for future in [pool.submit(
+                        _decrypt_fragments, inpath, outpath, self._keyargs, moov[2], chunk) for chunk in chunks]:
+                    future.result()
+
+            with open(outpath, 'r+b') as outfile:
+                position = 0
+
+                # boxes between fragments are copied as they are
+                for start, _, _, fragment_end in fragments:
+                    self._copy_range(data, outfile, position, start)
+                    position = fragment_end
+
+                self._copy_range(data, outfile, position, file_size)
+                outfile.seek(moov[0])
+                outfile.write(moov[1])
+
+        return True
+
+    def _copy_range(self, data, outfile, start, end):
+        outfile.seek(start)
+
+        for offset in range(start, end, self._BUFFER_SIZE):
+            outfile.write(data[offset:min(offset + self._BUFFER_SIZE, end)])
+
+    def _decrypt_fragment_at(self, data, start, payload, end):
+        moof = bytearray(data[start:end])
+        self._parse_moof(moof, payload - start, start, data)
+        samples, self._samples = self._samples, []
+        decrypted = []
+
+        for sample in samples:
+            offset, size = sample['offset'], sample['size']
+            sample_data = bytearray(data[offset:offset + size])
+            self._decrypt_sample(sample_data, sample)
+            decrypted.append((offset, sample_data))
+
+        return moof, decrypted
+
+    def _scan_fragments(self, data, resume_offset):
+        # fragments before the resume offset have already been decrypted
+        moov, fragments, processed = None, [], resume_offset
+
+        for box_type, start, payload, end in _iter_boxes(data):
+            if box_type == b'moov':
+                box = bytearray(data[start:end])
+                self._parse_moov(box, payload - start)
+                moov = (start, box, (start, payload, end))
+            elif box_type == b'moof' and start >= resume_offset:
+                if start < processed:
+                    raise CencUnsupportedError('fragments are interleaved')
+
+                self._parse_moof(bytearray(data[start:end]), payload - start, start, data)
+                fragment_end = end
+
+                for sample in self._samples:
+                    if sample['offset'] < start:
+                        raise CencUnsupportedError('sample data precedes its fragment')
+                    fragment_end = max(fragment_end, sample['offset'] + sample['size'])
+
+                if fragment_end > len(data):
+                    raise CencUnsupportedError('sample data lies outside of the file')
+
+                self._samples = []
+                fragments.append((start, payload, end, fragment_end))
+                processed = fragment_end
+
+        return moov, fragments
+
+    def decrypt_fragment(self, data):
+        outfile = io.BytesIO()
+        self._process(io.BytesIO(data), outfile, len(data))
+        self._position += len(data)
+        return outfile.getvalue()
+
+    def _process(self, infile, outfile, file_size):
+        while (offset := infile.tell()) < file_size:
+            header = infile.read(8)
+
+            if len(header) < 8:
+                outfile.write(header)
+                break
+
+            size, box_type = struct.unpack('>I4s', header)
+
+            if size == 1:
+                header += infile.read(8)
+                size = struct.unpack_from('>Q', header, 8)[0]
+            elif size == 0:
+                size = file_size - offset
+
+            if size < len(header):
+                raise CencUnsupportedError(f'invalid box size at offset {offset}')
+
+            if box_type in (b'moov', b'moof'):
+                box = bytearray(header + infile.read(size - len(header)))
+
+                if box_type == b'moov':
+                    self._parse_moov(box, len(header))
+                else:
+                    self._parse_moof(box, len(header), self._position + offset, infile)
+
+                outfile.write(box)
+            else:
+                outfile.write(header)
+                self._copy(infile, outfile, offset + size)
+
+    def _copy(self, infile, outfile, end):
+        while (pos := infile.tell()) < end:
+            if self._samples and (offset := self._samples[0]['offset'] - self._position) < end:
+                sample = self._samples.pop(0)
+
+                if offset < pos:
+                    raise CencUnsupportedError('sample data precedes its fragment')
+
+                self._copy_clear(infile, outfile, offset)
+
+                if len(data := bytearray(infile.read(sample['size']))) < sample['size']:
+                    raise CencUnsupportedError('sample data is truncated')
+
+                self._decrypt_sample(data, sample)
+                outfile.write(data)
+            else:
+                self._copy_clear(infile, outfile, end)
+
+    def _copy_clear(self, infile, outfile, end):
+        while (remaining := end - infile.tell()) > 0:
+            if not (chunk := infile.read(min(remaining, self._BUFFER_SIZE))):
+                raise CencUnsupportedError('file is truncated')
+            outfile.write(chunk)
+
+    @_reject_malformed
+    def _parse_moov(self, moov, start):
+        for box_type, box_start, payload, box_end in _iter_boxes(moov, start):
+            if box_type == b'trak':
+                self._parse_trak(moov, payload, box_end)
+            elif box_type == b'mvex':
+                for trex_type, _, trex, _ in _iter_boxes(moov, payload, box_end):
+                    if trex_type == b'trex':
+                        track_id, _, _, default_size = struct.unpack_from('>4I', moov, trex + 4)
+                        self._tracks.setdefault(track_id, {})['default_size'] = default_size
+            elif box_type == b'pssh':
+                moov[box_start + 4:box_start + 8] = b'free'
+
+        if any(track.get('scheme') for track in self._tracks.values()) and not _find_box(moov, start, len(moov), b'mvex'):
+            raise CencUnsupportedError('file is not fragmented')
+
+    def _parse_trak(self, moov, start, end):
+        if not (tkhd := _find_box(moov, start, end, b'tkhd')):
+            return
+
+        track_id = struct.unpack_from('>I', moov, tkhd[0] + (20 if moov[tkhd[0]] == 1 else 12))[0]
+
+        if not (stsd := _find_box(moov, start, end, b'mdia', b'minf', b'stbl', b'stsd')):
+            return
+
+        for entry_type, entry_start, entry, entry_end in _iter_boxes(moov, stsd[0] + 8, stsd[1]):
+            if (children := _sample_entry_children(moov, entry_type, entry)) is None:
+                continue
+
+            if not (sinf := _find_box(moov, children, entry_end, b'sinf')):
+                continue
+
+            frma = _find_box(moov, *sinf, b'frma')
+            schm = _find_box(moov, *sinf, b'schm')
+            tenc = _find_box(moov, *sinf, b'schi', b'tenc')
+
+            if not frma or not schm or not tenc:
+                raise CencUnsupportedError('incomplete protection scheme information')
+
+            scheme = bytes(moov[schm[0] + 4:schm[0] + 8]).decode('latin-1')
+
+            if scheme not in ('cenc', 'cbcs'):
+                raise CencUnsupportedError(f'unsupported protection scheme: {scheme}')
+
+            track = self._tracks.setdefault(track_id, {})
+            track.update(scheme=scheme, **_parse_tenc(moov, tenc[0] + 4, moov[tenc[0]]))
+
+            if track['protected']:
+                self._get_key(track['kid'], track_id)
+
+            moov[entry_start + 4:entry_start + 8] = moov[frma[0]:frma[0] + 4]
+            moov[sinf[0] - 4:sinf[0]] = b'free'
+
+    @_reject_malformed
+    def _parse_moof(self, moof, start, moof_offset, infile):
+        data_end = moof_offset
+        samples = []
+
+        for box_type, box_start, payload, box_end in _iter_boxes(moof, start):
+            if box_type == b'traf':
+                data_end = self._parse_traf(moof, payload, box_end, moof_offset, data_end, infile, samples)
+            elif box_type == b'pssh':
+                moof[box_start + 4:box_start + 8] = b'free'
+
+        self._samples.extend(sorted(samples, key=lambda s: s['offset']))
+
+    def _parse_traf(self, moof, start, end, moof_offset, data_end, infile, samples):
+        boxes = {}
+
+        for box_type, box_start, payload, box_end in _iter_boxes(moof, start, end):
+            if box_type == b'uuid' and moof[payload:payload + 16] == self._PIFF_SENC_UUID:
+                box_type, payload = b'piff', payload + 16
+            elif box_type in (b'sbgp', b'sgpd') and moof[payload + 4:payload + 8] != b'seig':
+                continue
+
+            boxes.setdefault(box_type, []).append((box_start, payload, box_end))
+
+        if b'tfhd' not in boxes:
+            return data_end
+
+        tfhd = boxes[b'tfhd'][0][1]
+        flags, track_id = struct.unpack_from('>II', moof, tfhd)
+        flags &= 0xffffff
+        track = self._tracks.get(track_id, {})
+        default_size, offset = track.get('default_size', 0), tfhd + 8
+
+        if flags & 0x1:
+            base_offset = struct.unpack_from('>Q', moof, offset)[0]
+            offset += 8
+        else:
+            base_offset = moof_offset if flags & 0x20000 else data_end
+
+        offset += 4 if flags & 0x2 else 0
+        offset += 4 if flags & 0x8 else 0
+
+        if flags & 0x10:
+            default_size = struct.unpack_from('>I', moof, offset)[0]
+
+        sizes, sample_offsets = [], []
+        data_end = base_offset
+
+        for _, trun, trun_end in boxes.get(b'trun', []):
+            flags, count = struct.unpack_from('>II', moof, trun)
+            flags &= 0xffffff
+            offset = trun + 8
+
+            if flags & 0x1:
+                data_end = base_offset + struct.unpack_from('>i', moof, offset)[0]
+                offset += 4
+
+            offset += 4 if flags & 0x4 else 0
+            field_size = 4 * bin(flags & 0xf00).count('1')
+
+            if offset + count * field_size > trun_end:
+                raise CencUnsupportedError('track run box is truncated')
+
+            for _ in range(count):
+                sample_offset = offset + (4 if flags & 0x100 else 0)
+                size = struct.unpack_from('>I', moof, sample_offset)[0] if flags & 0x200 else default_size
+                sizes.append(size)
+                sample_offsets.append(data_end)
+                data_end += size
+                offset += field_size
+
+        if not track.get('scheme'):
+            return data_end
+
+        for box_type in (b'senc', b'piff', b'saiz', b'saio', b'sbgp', b'sgpd'):
+            for box_start, _, _ in boxes.get(box_type, []):
+                moof[box_start + 4:box_start + 8] = b'free'
+
+        groups = self._parse_sample_groups(moof, boxes, track, len(sizes))
+
+        if any(group['protected'] for group in groups):
+            aux_info = self._parse_aux_info(moof, boxes, groups, base_offset, moof_offset, infile)
+
+            for offset, size, group, (iv, subsamples) in zip(sample_offsets, sizes, groups, aux_info):
+                if group['protected']:
+                    samples.append({
+                        **group,
+                        'scheme': track['scheme'],
+                        'offset': offset,
+                        'size': size,
+                        'iv': iv or group['constant_iv'],
+                        'subsamples': subsamples,
+                        'key': self._get_key(group['kid'], track_id),
+                    })
+
+        return data_end
+
+    def _parse_sample_groups(self, moof, boxes, track, count):
+        defaults = {key: track[key] for key in ('protected', 'iv_size', 'kid', 'crypt', 'skip', 'constant_iv')}
+        entries = []
+
+        for _, sgpd, _ in boxes.get(b'sgpd', []):
+            version = moof[sgpd]
+            offset = sgpd + 8
+            default_length = 0
+
+            if version >= 1:
+                default_length = struct.unpack_from('>I', moof, offset)[0]
+                offset += 4
+
+            offset += 4 if version >= 2 else 0
+            entry_count = struct.unpack_from('>I', moof, offset)[0]
+            offset += 4
+
+            for _ in range(entry_count):
+                if not (length := default_length):
+                    length = struct.unpack_from('>I', moof, offset)[0]
+                    offset += 4
+
+                entries.append(_parse_tenc(moof, offset, 1))
+                offset += length
+
+        groups = []
+
+        for _, sbgp, _ in boxes.get(b'sbgp', []):
+            offset = sbgp + (12 if moof[sbgp] == 1 else 8)
+
+            for _ in range(struct.unpack_from('>I', moof, offset)[0]):
+                sample_count, index = struct.unpack_from('>II', moof, offset + 4)
+                offset += 8
+
+                if not index:
+                    group = defaults
+                elif index > 0x10000 and index - 0x10001 < len(entries):
+                    group = entries[index - 0x10001]
+                else:
+                    raise CencUnsupportedError('sample group description is not in the fragment')
+
+                groups.extend([group] * min(sample_count, count - len(groups)))
+
+        return (groups + [defaults] * count)[:count]
+
+    def _parse_aux_info(self, moof, boxes, groups, base_offset, moof_offset, infile):
+        if senc := boxes.get(b'senc') or boxes.get(b'piff'):
+            _, payload, end = senc[0]
+            return self._parse_senc(moof, payload, end, groups)
+
+        if b'saiz' not in boxes or b'saio' not in boxes:
+            raise CencUnsupportedError('sample encryption information not found')
+
+        _, saiz, _ = boxes[b'saiz'][0]
+        offset = saiz + (12 if moof[saiz + 3] & 1 else 4)
+        default_size, count = struct.unpack_from('>BI', moof, offset)
+        count = min(count, len(groups))
+        sizes = [default_size] * count if default_size else list(moof[offset + 5:offset + 5 + count])
+
+        _, saio, _ = boxes[b'saio'][0]
+        offset = saio + (12 if moof[saio + 3] & 1 else 4)
+
+        if struct.unpack_from('>I', moof, offset)[0] != 1:
+            raise CencUnsupportedError('sample auxiliary information is not contiguous')
+
+        aux_offset = base_offset + struct.unpack_from('>Q' if moof[saio] else '>I', moof, offset + 4)[0]
+
+        if moof_offset <= aux_offset and aux_offset + sum(sizes) <= moof_offset + len(moof):
+            data = moof[aux_offset - moof_offset:aux_offset - moof_offset + sum(sizes)]
+        else:
+            pos = infile.tell()
+            infile.seek(aux_offset - self._position)
+            data = infile.read(sum(sizes))
+            infile.seek(pos)
+
+        aux_info, offset = [], 0
+
+        for size, group in zip(sizes, groups):
+            iv_size = group['iv_size']
+            subsamples = None
+
+            if size > iv_size:
+                subsamples = [
+                    struct.unpack_from('>HI', data, offset + iv_size + 2 + 6 * i)
+                    for i in range(struct.unpack_from('>H', data, offset + iv_size)[0])]
+
+            aux_info.append((bytes(data[offset:offset + iv_size]), subsamples))
+            offset += size
+
+        return aux_info
+
+    def _parse_senc(self, moof, start, end, groups):
+        flags = struct.unpack_from('>I', moof, start)[0] & 0xffffff
+        offset = start + 4
+
+        if flags & 0x1:
+            # PIFF override of the track encryption defaults
+            offset += 20
+
+        count = struct.unpack_from('>I', moof, offset)[0]
+        offset += 4
+        aux_info = []
+
+        for group in groups[:count]:
+            iv = bytes(moof[offset:offset + group['iv_size']])
+            offset += group['iv_size']
+            subsamples = None
+
+            if flags & 0x2:
+                subsample_count = struct.unpack_from('>H', moof, offset)[0]
+                subsamples = [struct.unpack_from('>HI', moof, offset + 2 + 6 * i) for i in range(subsample_count)]
+                offset += 2 + 6 * subsample_count
+
+            if offset > end:
+                raise CencUnsupportedError('sample encryption box is truncated')
+
+            aux_info.append((iv, subsamples))
+
+        return aux_info
+
+    def _get_key(self, kid, track_id):
+        if key := self._keys.get(kid) or self._keys.get(track_id):
+            return key
+
+        raise PostProcessingError(f'No key found for KID {kid.hex()}')
+
+    @_reject_malformed
+    def _decrypt_sample(self, data, sample):
+        ranges = [(0, len(data))]
+
+        if subsamples := sample['subsamples']:
+            ranges, offset = [], 0
+
+            for clear, protected in subsamples:
+                ranges.append((offset + clear, protected))
+                offset += clear + protected
+
+            if offset > len(data):
+                raise CencUnsupportedError('subsamples exceed the sample size')
+
+        if sample['scheme'] == 'cenc':
+            self._decrypt_ranges(
+                data, ranges, AES.new(sample['key'], AES.MODE_CTR, nonce=b'', initial_value=sample['iv'].ljust(16, b'\0')))
+            return
+
+        crypt, skip = sample['crypt'], sample['skip']
+
+        for offset, size in ranges:
+            if not crypt and not skip:
+                blocks = [(offset, size & ~0xf)]
+            else:
+                stride = (crypt + skip) * 16
+                blocks = [
+                    (pos, min(crypt * 16, (offset + size - pos) & ~0xf))
+                    for pos in range(offset, offset + size - 15, stride)]
+
+            self._decrypt_ranges(data, blocks, AES.new(sample['key'], AES.MODE_CBC, sample['iv'].ljust(16, b'\0')))
+
+    def _decrypt_ranges(self, data, ranges, cipher):
+        view = memoryview(data)
+        decrypted = memoryview(cipher.decrypt(b''.join(view[offset:offset + size] for offset, size in ranges)))
+        pos = 0
+
+        for offset, size in ranges:
+            view[offset:offset + size] = decrypted[pos:pos + size]
+            pos += size
+
+
+def _decrypt_fragments(inpath, outpath, keys, moov, fragments):
+    decrypter = CencDecrypter(keys)
+
+    with open(inpath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data, \
+            open(outpath, 'r+b') as outfile:
+        start, payload, end = moov
+        decrypter._parse_moov(bytearray(data[start:end]), payload - start)
+
+        for start, payload, end, fragment_end in fragments:
+            moof, samples = decrypter._decrypt_fragment_at(data, start, payload, end)
+            fragment = bytearray(data[start:fragment_end])
+            fragment[:end - start] = moof
+
+            for offset, sample_data in samples:
+                fragment[offset - start:offset - start + len(sample_data)] = sample_data
+
+            outfile.seek(start)
+            outfile.write(fragment)
+
+
+class CencJournal:
+    _HEADER = struct.Struct('>8s6Q')
+    _MAGIC = b'MP4DJRN1'
+
+    def __init__(self, path):
+        self._path = path
+
+    def recover(self, data):
+        try:
+            with open(self._path, 'rb') as f:
+                journal = f.read()
+        except FileNotFoundError:
+            return 0
+
+        if len(journal) < self._HEADER.size:
+            return 0
+
+        magic, file_size, resume_offset, undo_offset, undo_size, check_offset, check_size = \
+            self._HEADER.unpack_from(journal)
+        check = journal[self._HEADER.size:self._HEADER.size + check_size]
+        undo = journal[self._HEADER.size + check_size:]
+
+        # ignore journals left behind by another file with the same name
+        if magic != self._MAGIC or file_size != len(data) or len(undo) != undo_size \
+                or data[check_offset:check_offset + check_size] != check:
+            return 0
+
+        data[undo_offset:undo_offset + undo_size] = undo
+        data.flush()
+        return resume_offset
+
+    def write(self, file_size, resume_offset, undo, check):
+        undo_offset, undo_data = undo
+        check_offset, check_data = check
+        tmppath = self._path + '.tmp'
+
+        with open(tmppath, 'wb') as f:
+            f.write(self._HEADER.pack(
+                self._MAGIC, file_size, resume_offset, undo_offset, len(undo_data), check_offset, len(check_data)))
+            f.write(check_data)
+            f.write(undo_data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmppath, self._path)
+
+    def remove(self):
+        if os.path.exists(self._path):
+            os.remove(self._path)
+
+
+class InitCache:
+    _STRIPPED_HEADERS = ('content-length', 'content-encoding', 'transfer-encoding')
+
+    def __init__(self, limit):
+        self._limit = limit
+        self._size = 0
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    @staticmethod
+    def _key(request):
+        if request.method != 'GET' or request.data is not None:
+            return None
+
+        return request.url, request.headers.get('Range')
+
+    def add(self, request, response, data):
+        if not (key := self._key(request)) or len(data) > self._limit // 8:
+            return
+
+        # the body has already been decoded, so the original length and encoding no longer apply
+        headers = {name: value for name, value in response.headers.items() if name.lower() not in self._STRIPPED_HEADERS}
+        headers['Content-Length'] = str(len(data))
+
+        with self._lock:
+            if old := self._entries.pop(key, None):
+                self._size -= len(old[3])
+
+            self._entries[key] = (response.url, headers, response.status, data)
+            self._size += len(data)
+
+            while self._size > self._limit:
+                _, old = self._entries.popitem(last=False)
+                self._size -= len(old[3])
+
+    def pop(self, request):
+        if not (key := self._key(request)):
+            return None
+
+        with self._lock:
+            if not (entry := self._entries.pop(key, None)):
+                return None
+
+            self._size -= len(entry[3])
+
+        url, headers, status, data = entry
+        return Response(io.BytesIO(data), url, headers, status=status)
+
+
+class KeyStore:
+    _TOUCH_BATCH = 64
+
+    def __init__(self, path, ttl=None, limit=None):
+        self._ttl = ttl
+        self._limit = limit
+        self._lock = threading.Lock()
+        self._touched = {'keys': {}, 'pssh': {}}
+
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+
+        with self._transaction() as db:
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS keys (
+                    kid TEXT PRIMARY KEY, key TEXT NOT NULL, expires REAL, last_used REAL NOT NULL)''')
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS pssh (
+                    hash TEXT PRIMARY KEY, kids TEXT NOT NULL, expires REAL, last_used REAL NOT NULL)''')
+            db.execute('CREATE INDEX IF NOT EXISTS keys_last_used ON keys (last_used)')
+            db.execute('CREATE INDEX IF NOT EXISTS pssh_last_used ON pssh (last_used)')
+
+    @contextlib.contextmanager
+    def _transaction(self, mode='IMMEDIATE'):
+        with self._lock:
+            self._db.execute(f'BEGIN {mode}')
+
+            try:
+                yield self._db
+                self._db.execute('COMMIT')
+            except BaseException:
+                if self._db.in_transaction:
+                    self._db.execute('ROLLBACK')
+                raise
+
+    @staticmethod
+    def _hash(pssh):
+        return hashlib.md5(pssh.encode('ascii')).hexdigest()
+
+    def get(self, pssh):
+        now = time.time()
+
+        with self._transaction('DEFERRED') as db:
+            row = db.execute(
+                'SELECT kids FROM pssh WHERE hash = ? AND (expires IS NULL OR expires > ?)',
+                (self._hash(pssh), now)).fetchone()
+
+            if not row:
+                return None
+
+            kids = row[0].split(',')
+
+            if not (keys := self._get_keys(db, kids, now)):
+                return None
+
+        self._touch(now, kids, self._hash(pssh))
+        return keys
+
+    def get_kids(self, kids):
+        now = time.time()
+
+        with self._transaction('DEFERRED') as db:
+            if not (keys := self._get_keys(db, kids, now)):
+                return None
+
+        self._touch(now, kids)
+        return keys
+
+    def _get_keys(self, db, kids, now):
+        keys = dict(db.execute(
+            'SELECT kid, key FROM keys WHERE kid IN (%s) AND (expires IS NULL OR expires > ?)' % ','.join('?' * len(kids)),
+            (*kids, now)))
+
+        if len(keys) != len(kids):
+            return None
+
+        return tuple(arg for kid in kids for arg in ('--key', f'{kid}:{keys[kid]}'))
+
+    def _touch(self, now, kids, pssh_hash=None):
+        with self._lock:
+            self._touched['keys'].update(dict.fromkeys(kids, now))
+
+            if pssh_hash:
+                self._touched['pssh'][pssh_hash] = now
+
+            if sum(map(len, self._touched.values())) < self._TOUCH_BATCH:
+                return
+
+        # last_used only orders eviction, so a busy database just delays the update
+        with contextlib.suppress(sqlite3.OperationalError), self._transaction() as db:
+            self._flush_touched(db)
+
+    def _flush_touched(self, db):
+        for table, column in (('keys', 'kid'), ('pssh', 'hash')):
+            db.executemany(
+                f'UPDATE {table} SET last_used = MAX(last_used, ?) WHERE {column} = ?',
+                ((now, key) for key, now in self._touched[table].items()))
+
+        for touched in self._touched.values():
+            touched.clear()
+
+    def store(self, pssh, keys):
+        now = time.time()
+        expires = now + self._ttl if self._ttl else None
+        pairs = [keyarg.split(':', 1) for keyarg in keys[1::2]]
+
+        with self._transaction() as db:
+            self._flush_touched(db)
+            db.executemany(
+                'INSERT OR REPLACE INTO keys VALUES (?, ?, ?, ?)',
+                ((kid, key, expires, now) for kid, key in pairs))
+            db.execute(
+                'INSERT OR REPLACE INTO pssh VALUES (?, ?, ?, ?)',
+                (self._hash(pssh), ','.join(kid for kid, _ in pairs), expires, now))
+            self._evict(db, now)
+
+    def _evict(self, db, now):
+        for table, column in (('keys', 'kid'), ('pssh', 'hash')):
+            db.execute(f'DELETE FROM {table} WHERE expires <= ?', (now,))
+
+            if self._limit:
+                db.execute(
+                    f'DELETE FROM {table} WHERE {column} NOT IN '
+                    f'(SELECT {column} FROM {table} ORDER BY last_used DESC LIMIT ?)', (self._limit,))
+
+
+class Metrics:
+    def __init__(self, path=None, prometheus_path=None):
+        self._path = path
+        self._prometheus_path = prometheus_path
+        self._lock = threading.Lock()
+        self._durations = {}
+        self._sizes = {}
+        self._counts = {}
+
+    @contextlib.contextmanager
+    def measure(self, phase, **fields):
+        start = time.perf_counter()
+
+        try:
+            yield fields
+        except BaseException:
+            fields['failed'] = True
+            raise
+        finally:
+            self.record(phase, time.perf_counter() - start, **fields)
+
+    def record(self, phase, duration, **fields):
+        if not self._path and not self._prometheus_path:
+            return
+
+        size = fields.pop('size', None)
+        labels = (('phase', phase), *sorted((k, v) for k, v in fields.items() if isinstance(v, str)))
+        event = {'event': phase, **fields, 'duration': round(duration, 6)}
+
+        if size is not None:
+            event['bytes'] = size
+
+            if duration > 0:
+                event['throughput'] = round(size / duration / 1e6, 3)
+
+        with self._lock:
+            count, total = self._durations.get(labels, (0, 0))
+            self._durations[labels] = (count + 1, total + duration)
+
+            if size is not None:
+                self._sizes[labels] = self._sizes.get(labels, 0) + size
+
+            self._write(event)
+
+    def count(self, name, **labels):
+        if not self._path and not self._prometheus_path:
+            return
+
+        with self._lock:
+            key = (name, *sorted(labels.items()))
+            self._counts[key] = self._counts.get(key, 0) + 1
+            self._write({'event': name, **labels})
+
+    def _write(self, event):
+        if self._path:
+            with open(self._path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'timestamp': round(time.time(), 3), **event}) + '\n')
+
+        if self._prometheus_path:
+            tmppath = self._prometheus_path + '.tmp'
+
+            with open(tmppath, 'w', encoding='utf-8') as f:
+                f.write(self._format_prometheus())
+
+            os.replace(tmppath, self._prometheus_path)
+
+    def _format_prometheus(self):
+        lines = ['# TYPE mp4decrypt_duration_seconds summary']
+
+        for labels, (count, total) in sorted(self._durations.items()):
+            lines.append(f'mp4decrypt_duration_seconds_count{self._format_labels(labels)} {count}')
+            lines.append(f'mp4decrypt_duration_seconds_sum{self._format_labels(labels)} {total:.6f}')
+
+        lines.append('# TYPE mp4decrypt_bytes_total counter')
+
+        for labels, size in sorted(self._sizes.items()):
+            lines.append(f'mp4decrypt_bytes_total{self._format_labels(labels)} {size}')
+
+        for name in sorted({name for name, *_ in self._counts}):
+            lines.append(f'# TYPE mp4decrypt_{name}_total counter')
+
+            for (counter, *labels), count in sorted(self._counts.items()):
+                if counter == name:
+                    lines.append(f'mp4decrypt_{name}_total{self._format_labels(labels)} {count}')
+
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ''
+
+        return '{%s}' % ','.join('{}="{}"'.format(
+            key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in labels)
+
+
+class CdmPool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._path_locks = {}
+        self._cdms = {}
+
+    def _get(self, path):
+        path = os.path.abspath(path)
+
+        with self._lock:
+            path_lock = self._path_locks.setdefault(path, threading.Lock())
+
+        # only callers of the same device wait for it to be loaded
+        with path_lock:
+            if path not in self._cdms:
+                self._cdms[path] = (
+                    Cdm.from_device(Device.load(path)), threading.BoundedSemaphore(Cdm.MAX_NUM_OF_SESSIONS))
+
+            return self._cdms[path]
+
+    @contextlib.contextmanager
+    def session(self, path):
+        cdm, sessions = self._get(path)
+
+        with sessions:
+            session_id = cdm.open()
+
+            try:
+                yield cdm, session_id
+            finally:
+                cdm.close(session_id)
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, timeout=None):
+        with self._lock:
+            call = self._calls.get(key)
+
+            if not call:
+                call = self._calls[key] = concurrent.futures.Future()
+                call.set_running_or_notify_cancel()
+                leader = True
+            else:
+                leader = False
+
+        if not leader:
+            return call.result(timeout)
+
+        try:
+            result = func()
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+_cdm_pool = CdmPool()
+_license_requests = SingleFlight()